@@ -27,9 +27,12 @@ import logging
 import binascii
 import wyzesense
 
+# Strips restructured text formatting from the usage text before docopt
+USAGE_RE = re.compile(r'(?<=\n)\*\*(\w+:)\*\*.*\n')
+
 
 def on_event(ws, e):
-    s = f"[{e.Timestamp.strftime('%Y-%m-%d %H:%M:%S')}][{e.MAC}]"
+    s = f"[{wyzesense.format_timestamp(e.Timestamp.replace(microsecond=0))}][{e.MAC}]"
     if e.Type == 'state':
         (s_type, s_state, s_battery, s_signal) = e.Data
         s += f"StateEvent: sensor_type={s_type}, state={s_state}, " \
@@ -109,17 +112,17 @@ def main(args):
         print("Bad sensors removed")
         logging.debug("Bad sensors removed")
 
-    def HandleCmd():
-        cmd_handlers = {
-            'L': ('L - List paired sensors', List),
-            'P': ('P - Pair new sensors', Pair),
-            'U': ('U <mac> - Unpair sensor', Unpair),
-            'F': ('F - Fix invalid sensors', Fix),
-            'X': ('X - Exit tool', None),
-        }
+    cmd_handlers = {
+        'L': ('L - List paired sensors', List),
+        'P': ('P - Pair new sensors', Pair),
+        'U': ('U <mac> - Unpair sensor', Unpair),
+        'F': ('F - Fix invalid sensors', Fix),
+        'X': ('X - Exit tool', None),
+    }
+    cmd_help = "\n".join(v[0] for v in cmd_handlers.values())
 
-        for v in list(cmd_handlers.values()):
-            print(v[0])
+    def HandleCmd():
+        print(cmd_help)
 
         cmd_and_args = input("Action:").strip().upper().split()
         if len(cmd_and_args) == 0:
@@ -156,5 +159,5 @@ if __name__ == '__main__':
         sys.exit("the 'docopt' module is needed to execute this program")
 
     # remove restructured text formatting before input to docopt
-    usage = re.sub(r'(?<=\n)\*\*(\w+:)\*\*.*\n', r'\1', __doc__)
+    usage = USAGE_RE.sub(r'\1', __doc__)
     sys.exit(main(docopt(usage)))
@@ -3,7 +3,9 @@ from builtins import str
 
 import os
 import time
+import select
 import struct
+import functools
 import threading
 import datetime
 import binascii
@@ -20,7 +22,8 @@ def bytes_to_hex(s):
 
 
 def checksum_from_bytes(s):
-    return sum(bytes(s)) & 0xFFFF
+    # sum() iterates bytes, bytearray and memoryview natively, no copy needed
+    return sum(s) & 0xFFFF
 
 
 TYPE_SYNC = 0x43
@@ -31,9 +34,21 @@ def MAKE_CMD(type, cmd):
     return (type << 8) | cmd
 
 
+# Packet header (magic, command type, length or ACK'd command id, command id) and checksum
+PACKET_HEADER = struct.Struct(">HBBB")
+PACKET_CHECKSUM = struct.Struct(">H")
+
+# Sensor alarm (timestamp, event type, MAC) and event log (timestamp, length) payload headers
+ALARM_HEADER = struct.Struct(">QB8s")
+EVENT_LOG_HEADER = struct.Struct(">QB")
+
+
 class Packet(object):
     _CMD_TIMEOUT = 5
 
+    # Header (5 bytes) with a one byte length covering the command and checksum
+    MAX_LENGTH = 0xFF + 4
+
     # Sync packets:
     # Commands initiated from host side
     CMD_GET_ENR = MAKE_CMD(TYPE_SYNC, 0x02)
@@ -63,11 +78,8 @@ class Packet(object):
     NOTIFY_EVENT_LOG = MAKE_CMD(TYPE_ASYNC, 0x35)
 
     def __init__(self, cmd, payload=bytes()):
+        # payload is the ACK'd command (int) for ASYNC_ACK, bytes otherwise
         self._cmd = cmd
-        if self._cmd == self.ASYNC_ACK:
-            assert isinstance(payload, int)
-        else:
-            assert isinstance(payload, bytes)
         self._payload = payload
 
     def __str__(self):
@@ -92,40 +104,42 @@ class Packet(object):
         return self._payload
 
     def Send(self, fd):
-        pkt = bytes()
+        pkt = bytearray(self.Length)
 
-        pkt += struct.pack(">HB", 0xAA55, self._cmd >> 8)
         if self._cmd == self.ASYNC_ACK:
-            pkt += struct.pack("BB", (self._payload & 0xFF), self._cmd & 0xFF)
+            PACKET_HEADER.pack_into(pkt, 0, 0xAA55, self._cmd >> 8, (self._payload & 0xFF), self._cmd & 0xFF)
         else:
-            pkt += struct.pack("BB", len(self._payload) + 3, self._cmd & 0xFF)
-            if self._payload:
-                pkt += self._payload
+            PACKET_HEADER.pack_into(pkt, 0, 0xAA55, self._cmd >> 8, len(self._payload) + 3, self._cmd & 0xFF)
+            pkt[5:-2] = self._payload
 
+        # The checksum bytes are still zero, so summing the whole packet is safe
         checksum = checksum_from_bytes(pkt)
-        pkt += struct.pack(">H", checksum)
-        log.debug("Sending: %s", bytes_to_hex(pkt))
+        PACKET_CHECKSUM.pack_into(pkt, len(pkt) - 2, checksum)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Sending: %s", bytes_to_hex(pkt))
         ss = os.write(fd, pkt)
-        assert ss == len(pkt)
+        if ss != len(pkt):
+            raise IOError("Short write, sent %d of %d bytes: %s" % (ss, len(pkt), bytes_to_hex(pkt)))
 
     @classmethod
     def Parse(cls, s):
-        assert isinstance(s, bytes)
-
         if len(s) < 5:
             log.error("Invalid packet: %s", bytes_to_hex(s))
             log.error("Invalid packet length: %d", len(s))
             return None
 
-        magic, cmd_type, b2, cmd_id = struct.unpack_from(">HBBB", s)
+        magic, cmd_type, b2, cmd_id = PACKET_HEADER.unpack_from(s)
         if magic != 0x55AA and magic != 0xAA55:
             log.error("Invalid packet: %s", bytes_to_hex(s))
             log.error("Invalid packet magic: %4X", magic)
             return None
 
-        cmd = MAKE_CMD(cmd_type, cmd_id)
+        # MAKE_CMD inlined, this runs for every received packet
+        cmd = (cmd_type << 8) | cmd_id
         if cmd == cls.ASYNC_ACK:
-            assert len(s) >= 7
+            if len(s) < 7:
+                log.error("Invalid packet: %s", bytes_to_hex(s))
+                return None
             s = s[:7]
             payload = MAKE_CMD(cmd_type, b2)
         elif len(s) >= b2 + 4:
@@ -221,11 +235,21 @@ class Packet(object):
 
     @classmethod
     def AsyncAck(cls, cmd):
-        assert (cmd >> 0x8) == TYPE_ASYNC
+        if (cmd >> 0x8) != TYPE_ASYNC:
+            raise ValueError("Not an async command, no ACK: %04X" % cmd)
         return cls(cls.ASYNC_ACK, cmd)
 
 
+# Events often arrive in bursts within the same second, reuse the formatted time
+@functools.lru_cache(maxsize=4)
+def format_timestamp(timestamp):
+    return timestamp.strftime("%Y-%m-%d %H:%M:%S")
+
+
 class SensorEvent(object):
+    # One is created per sensor packet, skip the per-instance __dict__
+    __slots__ = ('MAC', 'Timestamp', 'Type', 'Data')
+
     def __init__(self, mac, timestamp, event_type, event_data):
         self.MAC = mac
         self.Timestamp = timestamp
@@ -233,7 +257,7 @@ class SensorEvent(object):
         self.Data = event_data
 
     def __str__(self):
-        s = "[%s][%s]" % (self.Timestamp.strftime("%Y-%m-%d %H:%M:%S"), self.MAC)
+        s = "[%s][%s]" % (format_timestamp(self.Timestamp.replace(microsecond=0)), self.MAC)
         if self.Type == 'alarm':
             s += "AlarmEvent: sensor_type=%s, state=%s, battery=%d, signal=%d" % self.Data
         elif self.Type == 'status':
@@ -245,6 +269,18 @@ class SensorEvent(object):
 
 class Dongle(object):
     _CMD_TIMEOUT = 2
+    _BUFFER_COMPACT_SIZE = 0x1000
+    _POLL_TIMEOUT = 1000
+    _POLL_ERROR = select.POLLHUP | select.POLLERR | select.POLLNVAL
+
+    # {sensor_id: ("sensor type", ["off state", "on state"])}
+    _SENSOR_TYPES = {
+        0x01: ("switch", ["close", "open"]),
+        0x0E: ("switchv2", ["close", "open"]),
+        0x02: ("motion", ["inactive", "active"]),
+        0x0F: ("motionv2", ["inactive", "active"]),
+        0x03: ("leak", ["dry", "wet"]),
+    }
 
     class CmdContext(object):
         def __init__(self, **kwargs):
@@ -256,31 +292,19 @@ class Dongle(object):
             log.info("Unknown alarm packet: %s", bytes_to_hex(pkt.Payload))
             return
 
-        timestamp, event_type, sensor_mac = struct.unpack_from(">QB8s", pkt.Payload)
+        timestamp, event_type, sensor_mac = ALARM_HEADER.unpack_from(pkt.Payload)
         timestamp = datetime.datetime.fromtimestamp(timestamp / 1000.0)
         sensor_mac = sensor_mac.decode('ascii')
         alarm_data = pkt.Payload[17:]
 
-        # {sensor_id: "sensor type", "states": ["off state", "on state"]}
-        contact_ids = {0x01: "switch", 0x0E: "switchv2", "states": ["close", "open"]}
-        motion_ids = {0x02: "motion", 0x0F: "motionv2", "states": ["inactive", "active"]}
-        leak_ids = {0x03: "leak", "states": ["dry", "wet"]}
-
         if event_type == 0xA2 or event_type == 0xA1:
-            sensor = {}
-            if alarm_data[0] in contact_ids:
-                sensor = contact_ids
-            elif alarm_data[0] in motion_ids:
-                sensor = motion_ids
-            elif alarm_data[0] in leak_ids:
-                sensor = leak_ids
-            
+            sensor = self._SENSOR_TYPES.get(alarm_data[0])
             if sensor:
-                sensor_type = sensor[alarm_data[0]]
-                sensor_state = sensor["states"][alarm_data[5]]
+                sensor_type = sensor[0]
+                sensor_state = sensor[1][alarm_data[5]]
             else:
-                sensor_type = "unknown (" + alarm_data[0] + ")"
-                sensor_state = "unknown (" + alarm_data[5] + ")"
+                sensor_type = "unknown (%d)" % alarm_data[0]
+                sensor_state = "unknown (%d)" % alarm_data[5]
             e = SensorEvent(sensor_mac, timestamp, ("alarm" if event_type == 0xA2 else "status"), (sensor_type, sensor_state, alarm_data[2], alarm_data[8]))
         elif event_type == 0xE8:
             if alarm_data[0] == 0x03:
@@ -292,14 +316,22 @@ class Dongle(object):
         else:
             e = SensorEvent(sensor_mac, timestamp, "raw_%02X" % event_type, alarm_data)
 
-        self.__on_event(self, e)
+        # Don't let a failing handler kill the worker thread
+        try:
+            self.__on_event(self, e)
+        except Exception:
+            log.exception("Event handler failed: %s", e)
 
     def _OnSyncTime(self, pkt):
         self._SendPacket(Packet.SyncTimeAck())
 
     def _OnEventLog(self, pkt):
-        assert len(pkt.Payload) >= 9
-        ts, msg_len = struct.unpack_from(">QB", pkt.Payload)
+        if len(pkt.Payload) < 9:
+            log.info("Unknown event log packet: %s", bytes_to_hex(pkt.Payload))
+            return
+        if not log.isEnabledFor(logging.INFO):
+            return
+        ts, msg_len = EVENT_LOG_HEADER.unpack_from(pkt.Payload)
         # assert msg_len + 8 == len(pkt.Payload)
         tm = datetime.datetime.fromtimestamp(ts / 1000.0)
         msg = pkt.Payload[9:]
@@ -308,6 +340,15 @@ class Dongle(object):
     def __init__(self, device, event_handler):
         self.__lock = threading.Lock()
         self.__fd = os.open(device, os.O_RDWR | os.O_NONBLOCK)
+        # The worker blocks in poll() until the dongle has data, Stop() writes
+        # to the wake pipe to unblock it
+        self.__wake_r, self.__wake_w = os.pipe()
+        self.__poll = select.poll()
+        self.__poll.register(self.__fd, select.POLLIN)
+        self.__poll.register(self.__wake_r, select.POLLIN)
+        # HID reports are read into one reusable buffer
+        self.__rx = bytearray(0x40)
+        self.__rx_view = memoryview(self.__rx)
         self.__sensors = {}
         self.__exit_event = threading.Event()
         self.__thread = threading.Thread(target=self._Worker)
@@ -323,23 +364,23 @@ class Dongle(object):
 
     def _ReadRawHID(self):
         try:
-            s = os.read(self.__fd, 0x40)
+            count = os.readv(self.__fd, [self.__rx])
         except OSError:
             return b""
 
-        if not s:
+        if not count:
             log.info("Nothing read")
             return b""
 
-        s = bytes(s)
-        length = s[0]
-        assert length > 0
+        length = self.__rx[0]
         if length > 0x3F:
             length = 0x3F
 
-        # log.debug("Raw HID packet: %s", bytes_to_hex(s))
-        assert len(s) >= length + 1
-        return s[1: 1 + length]
+        # log.debug("Raw HID packet: %s", bytes_to_hex(self.__rx[:count]))
+        if length == 0 or count < length + 1:
+            log.error("Invalid HID report: %s", bytes_to_hex(self.__rx[:count]))
+            return b""
+        return bytes(self.__rx_view[1: 1 + length])
 
     def _SetHandler(self, cmd, handler):
         with self.__lock:
@@ -349,46 +390,70 @@ class Dongle(object):
         return oldHandler
 
     def _SendPacket(self, pkt):
-        log.debug("===> Sending: %s", str(pkt))
+        log.debug("===> Sending: %s", pkt)
         pkt.Send(self.__fd)
 
     def _DefaultHandler(self, pkt):
         pass
 
     def _HandlePacket(self, pkt):
-        log.debug("<=== Received: %s", str(pkt))
+        log.debug("<=== Received: %s", pkt)
         with self.__lock:
             handler = self.__handlers.get(pkt.Cmd, self._DefaultHandler)
 
         if (pkt.Cmd >> 8) == TYPE_ASYNC and pkt.Cmd != Packet.ASYNC_ACK:
             # log.info("Sending ACK packet for cmd %04X", pkt.Cmd)
-            self._SendPacket(Packet.AsyncAck(pkt.Cmd))
+            # A failed ACK is logged, raising here would end the worker thread
+            try:
+                self._SendPacket(Packet.AsyncAck(pkt.Cmd))
+            except IOError as error:
+                log.error("Failed to ACK cmd %04X: %s", pkt.Cmd, error)
         handler(pkt)
 
     def _Worker(self):
-        s = b""
+        # Consumed bytes are tracked by pos and only dropped from buf once
+        # it is drained or pos grows large, instead of copying on every packet
+        buf = bytearray()
+        pos = 0
         while True:
             if self.__exit_event.isSet():
                 break
 
-            s += self._ReadRawHID()
-            # if s:
-            #     log.info("Incoming buffer: %s", bytes_to_hex(s))
-            start = s.find(b"\x55\xAA")
+            buf += self._ReadRawHID()
+            # if buf:
+            #     log.info("Incoming buffer: %s", bytes_to_hex(buf[pos:]))
+            start = buf.find(b"\x55\xAA", pos)
             if start == -1:
-                time.sleep(0.1)
+                # Keep the last byte, it may be the first half of the magic
+                del buf[:-1]
+                pos = 0
+                # A hung up or closed fd polls ready forever, stop instead of spinning
+                for fd, revents in self.__poll.poll(self._POLL_TIMEOUT):
+                    if fd == self.__fd and revents & self._POLL_ERROR:
+                        if not self.__exit_event.isSet():
+                            log.error("Dongle device error (poll events %04X), stopping worker", revents)
+                            self.__exit_event.set()
                 continue
 
-            s = s[start:]
-            log.debug("Trying to parse: %s", bytes_to_hex(s))
+            s = bytes(buf[start:start + Packet.MAX_LENGTH])
+            # Hex dumps are only built when debug logging is enabled
+            debug = log.isEnabledFor(logging.DEBUG)
+            if debug:
+                log.debug("Trying to parse: %s", bytes_to_hex(s))
             pkt = Packet.Parse(s)
             if not pkt:
-                s = s[2:]
-                continue
+                pos = start + 2
+            else:
+                if debug:
+                    log.debug("Received: %s", bytes_to_hex(s[:pkt.Length]))
+                pos = start + pkt.Length
+
+            if pos >= len(buf) or pos >= self._BUFFER_COMPACT_SIZE:
+                del buf[:pos]
+                pos = 0
 
-            log.debug("Received: %s", bytes_to_hex(s[:pkt.Length]))
-            s = s[pkt.Length:]
-            self._HandlePacket(pkt)
+            if pkt:
+                self._HandlePacket(pkt)
 
     def _DoCommand(self, pkt, handler, timeout=_CMD_TIMEOUT):
         e = threading.Event()
@@ -484,7 +549,9 @@ class Dongle(object):
             log.debug("%d sensors reported, waiting for each one to report...", count)
 
             def cmd_handler(pkt, e):
-                assert len(pkt.Payload) == 8
+                if len(pkt.Payload) != 8:
+                    log.error("Invalid sensor list entry: %s", bytes_to_hex(pkt.Payload))
+                    return
                 mac = pkt.Payload.decode('ascii')
                 log.debug("Sensor %d/%d, MAC:%s", ctx.index + 1, ctx.count, mac)
 
@@ -529,9 +596,12 @@ class Dongle(object):
 
     def Stop(self, timeout=_CMD_TIMEOUT):
         self.__exit_event.set()
+        os.write(self.__wake_w, b"x")
         os.close(self.__fd)
         self.__fd = None
         self.__thread.join(timeout)
+        os.close(self.__wake_r)
+        os.close(self.__wake_w)
 
     def Scan(self, timeout=60):
         log.debug("Start Scan...")
@@ -539,7 +609,9 @@ class Dongle(object):
         ctx = self.CmdContext(evt=threading.Event(), result=None)
 
         def scan_handler(pkt):
-            assert len(pkt.Payload) == 11
+            if len(pkt.Payload) != 11:
+                log.error("Invalid scan result: %s", bytes_to_hex(pkt.Payload))
+                return
             ctx.result = (pkt.Payload[1:9].decode('ascii'), pkt.Payload[9], pkt.Payload[10])
             ctx.evt.set()
 
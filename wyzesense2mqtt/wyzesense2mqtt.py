@@ -1,22 +1,43 @@
 '''
 WyzeSense to MQTT Gateway
 '''
+import atexit
+import copy
+import datetime
 import json
 import logging
 import logging.config
 import logging.handlers
 import os
+import queue
 import shutil
-import subprocess
+import signal
+import threading
+import time
 import yaml
 
-# Used for alternate MQTT connection method
-# import signal
-# import time
-
 import paho.mqtt.client as mqtt
 import wyzesense
-from retrying import retry
+
+# Prefer the LibYAML based loader and dumper when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
+
+# Prefer orjson for payload serialization, fall back to the stdlib encoder.
+# Both produce compact JSON without whitespace and datetimes in isoformat().
+try:
+    import orjson
+    json_dumps = orjson.dumps
+except ImportError:
+    def json_default(value):
+        if (isinstance(value, datetime.datetime)):
+            return value.isoformat()
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+    def json_dumps(data):
+        return json.dumps(data, separators=(',', ':'), default=json_default)
 
 
 # Configuration File Locations
@@ -34,12 +55,53 @@ DEVICE_CLASSES = {
     **dict.fromkeys([0x03, 'leak'], 'moisture')
 }
 
-# Read data from YAML file
+# Discovery entities and their Home Assistant component, (entity, component)
+DISCOVERY_ENTITY_TYPES = (
+    ('state', 'binary_sensor'),
+    ('signal_strength', 'sensor'),
+    ('battery', 'sensor')
+)
+
+# MACs reported by the dongle for bad or partially paired sensors, any MAC
+# containing a NUL byte is rejected as well
+INVALID_MACS = frozenset([
+    "00000000"
+])
+
+# Set of states that correlate to ON.
+STATES_ON = frozenset(['active', 'open', 'wet'])
+
+
+# Convert config value to bool, quoted strings like 'false' are truthy otherwise
+def config_bool(value):
+    if (isinstance(value, str)):
+        return (value.strip().lower() in ['true', 'yes', 'on', '1'])
+    return bool(value)
+
+
+# Guards SENSORS, which is modified from the dongle and MQTT network threads.
+# Never hold it across a dongle command, the dongle thread delivers replies.
+SENSORS_LOCK = threading.RLock()
+
+# Guards the retained discovery collection, shared by the MQTT network and timer threads
+RETAINED_DISCOVERY_LOCK = threading.Lock()
+
+# Parsed YAML files, {filename: (mtime, size, data)}
+YAML_CACHE = {}
+
+
+# Read data from YAML file, reparsing only if the file changed
 def read_yaml_file(filename):
     try:
-        with open(filename) as yaml_file:
-            data = yaml.safe_load(yaml_file)
-            return data
+        file_stat = os.stat(filename)
+        cached = YAML_CACHE.get(filename)
+        if ((cached is None) or (cached[:2] != (file_stat.st_mtime_ns, file_stat.st_size))):
+            with open(filename) as yaml_file:
+                data = yaml.load(yaml_file, Loader=YamlLoader)
+            cached = (file_stat.st_mtime_ns, file_stat.st_size, data)
+            YAML_CACHE[filename] = cached
+        # Callers modify the returned data, never hand out the cached copy
+        return copy.deepcopy(cached[2])
     except IOError as error:
         if (LOGGER is None):
             print(f"File error: {str(error)}")
@@ -47,21 +109,43 @@ def read_yaml_file(filename):
             LOGGER.error(f"File error: {str(error)}")
 
 
-# Write data to YAML file
+# Write data to YAML file, via a synced temp file so a crash can't leave it truncated
 def write_yaml_file(filename, data):
+    temp_filename = f"{filename}.tmp"
     try:
-        with open(filename, 'w') as yaml_file:
-            yaml_file.write(yaml.safe_dump(data))
-    except IOError as error:
+        # Skip the write if the file on disk already holds this data
+        cached = YAML_CACHE.get(filename)
+        if ((cached is not None) and (cached[2] == data)):
+            file_stat = os.stat(filename)
+            if (cached[:2] == (file_stat.st_mtime_ns, file_stat.st_size)):
+                return
+
+        yaml_data = yaml.dump(data, Dumper=YamlDumper)
+        with open(temp_filename, 'w') as yaml_file:
+            yaml_file.write(yaml_data)
+            # Make sure the data is on disk before the rename makes it visible
+            yaml_file.flush()
+            os.fsync(yaml_file.fileno())
+        os.replace(temp_filename, filename)
+
+        # Keep the cache current so the next read doesn't reparse our own write
+        file_stat = os.stat(filename)
+        YAML_CACHE[filename] = (file_stat.st_mtime_ns, file_stat.st_size, copy.deepcopy(data))
+    except (IOError, yaml.YAMLError) as error:
         if (LOGGER is None):
             print(f"File error: {str(error)}")
         else:
             LOGGER.error(f"File error: {str(error)}")
+        # Don't leave a partial temp file behind in the config folder
+        try:
+            os.remove(temp_filename)
+        except FileNotFoundError:
+            pass
 
 
 # Initialize logging
 def init_logging():
-    global LOGGER
+    global LOGGER, LOG_LISTENER
     if (not os.path.isfile(os.path.join(CONFIG_PATH, LOGGING_CONFIG_FILE))):
         print("Copying default logging config file...")
         try:
@@ -77,14 +161,27 @@ def init_logging():
     except IOError:
         print("Unable to create log folder")
     logging.config.dictConfig(logging_config)
+
+    # Hand records to a listener thread so handler I/O doesn't block event callbacks
+    root_logger = logging.getLogger()
+    log_queue = queue.Queue(-1)
+    LOG_LISTENER = logging.handlers.QueueListener(log_queue, *root_logger.handlers, respect_handler_level=True)
+    root_logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    LOG_LISTENER.start()
+    # Flush queued records on any exit, including exit() during init
+    atexit.register(LOG_LISTENER.stop)
+
     LOGGER = logging.getLogger("wyzesense2mqtt")
     LOGGER.debug("Logging initialized...")
 
 
 # Initialize configuration
 def init_config():
-    global CONFIG
+    global CONFIG, MQTT_QOS, MQTT_RETAIN, SELF_TOPIC_ROOT, HASS_TOPIC_ROOT, HASS_DISCOVERY, PUBLISH_SENSOR_NAME
+    global STATE_TOPICS, LAST_EVENT_KEYS, PUBLISHED_DISCOVERY_TOPICS, DISCOVERY_TOPIC_TEMPLATES
+    global RETAINED_DISCOVERY_TOPICS, RETAINED_DISCOVERY_PAYLOADS, RETAINED_DISCOVERY_TIMER, RETAINED_DISCOVERY_GENERATION
     LOGGER.debug("Initializing configuration...")
+    LOGGER.debug("Using YAML loader %s", YamlLoader.__name__)
 
     # load base config - allows for auto addition of new settings
     if (os.path.isfile(os.path.join(SAMPLES_PATH, MAIN_CONFIG_FILE))):
@@ -105,6 +202,28 @@ def init_config():
         LOGGER.info("Writing updated config file")
         write_yaml_file(os.path.join(CONFIG_PATH, MAIN_CONFIG_FILE), CONFIG)
 
+    # Cache settings read on every event and publish
+    MQTT_QOS = CONFIG['mqtt_qos']
+    MQTT_RETAIN = config_bool(CONFIG['mqtt_retain'])
+    SELF_TOPIC_ROOT = CONFIG['self_topic_root']
+    HASS_TOPIC_ROOT = CONFIG['hass_topic_root']
+    HASS_DISCOVERY = config_bool(CONFIG['hass_discovery'])
+    PUBLISH_SENSOR_NAME = config_bool(CONFIG['publish_sensor_name'])
+
+    # Discovery topic templates filled with the sensor MAC, (entity, template)
+    hass_topic_root = HASS_TOPIC_ROOT.replace("%", "%%")
+    DISCOVERY_TOPIC_TEMPLATES = tuple(
+        (entity, f"{hass_topic_root}/{component}/wyzesense_%s/{entity}/config")
+        for entity, component in DISCOVERY_ENTITY_TYPES
+    )
+    STATE_TOPICS = {}
+    LAST_EVENT_KEYS = {}
+    PUBLISHED_DISCOVERY_TOPICS = {}
+    RETAINED_DISCOVERY_TOPICS = []
+    RETAINED_DISCOVERY_PAYLOADS = {}
+    RETAINED_DISCOVERY_TIMER = None
+    RETAINED_DISCOVERY_GENERATION = 0
+
 
 # Initialize MQTT client connection
 def init_mqtt_client():
@@ -113,9 +232,11 @@ def init_mqtt_client():
     # mqtt.Client.connected_flag = False
 
     # Configure MQTT Client
-    MQTT_CLIENT = mqtt.Client(client_id=CONFIG['mqtt_client_id'], clean_session=CONFIG['mqtt_clean_session'])
+    MQTT_CLIENT = mqtt.Client(client_id=CONFIG['mqtt_client_id'], clean_session=config_bool(CONFIG['mqtt_clean_session']))
     MQTT_CLIENT.username_pw_set(username=CONFIG['mqtt_username'], password=CONFIG['mqtt_password'])
     MQTT_CLIENT.reconnect_delay_set(min_delay=1, max_delay=120)
+    # Allow bursts of QoS 1/2 publishes (discovery, reconnect) without waiting on acks
+    MQTT_CLIENT.max_inflight_messages_set(100)
     MQTT_CLIENT.on_connect = on_connect
     MQTT_CLIENT.on_disconnect = on_disconnect
     MQTT_CLIENT.on_message = on_message
@@ -131,92 +252,118 @@ def init_mqtt_client():
     #     time.sleep(1)
 
 
-# Retry forever on IO Error
-def retry_if_io_error(exception):
-    return isinstance(exception, IOError)
-
+# Find USB dongle by vendor (1A86) and product (E024) IDs in sysfs
+def find_dongle():
+    hidraw_path = "/sys/class/hidraw"
+    try:
+        device_names = os.listdir(hidraw_path)
+    except IOError as error:
+        LOGGER.warning(f"Unable to list {hidraw_path}: {str(error)}")
+        return None
 
-# Initialize USB dongle
-@retry(wait_exponential_multiplier=1000, wait_exponential_max=30000, retry_on_exception=retry_if_io_error)
+    for device_name in device_names:
+        try:
+            with open(os.path.join(hidraw_path, device_name, "device", "uevent")) as uevent_file:
+                uevent = uevent_file.read()
+        except IOError:
+            continue
+        # Match only the HID_ID line, e.g. HID_ID=0003:00001A86:0000E024
+        for line in uevent.splitlines():
+            if (line.startswith("HID_ID=")):
+                hid_id = line[7:].upper().split(":")
+                if ((len(hid_id) == 3) and (hid_id[1:] == ["00001A86", "0000E024"])):
+                    return f"/dev/{device_name}"
+                break
+    return None
+
+
+# Initialize USB dongle, retrying forever on IO Error with exponential backoff
 def init_wyzesense_dongle():
     global WYZESENSE_DONGLE, CONFIG
-    if (CONFIG['usb_dongle'].lower() == "auto"):
-        device_list = subprocess.check_output(
-            ["ls", "-la", "/sys/class/hidraw"]
-        ).decode("utf-8").lower()
-        for line in device_list.split("\n"):
-            if (("e024" in line) and ("1a86" in line)):
-                for device_name in line.split(" "):
-                    if ("hidraw" in device_name):
-                        CONFIG['usb_dongle'] = f"/dev/{device_name}"
-                        break
-
-    LOGGER.info(f"Connecting to dongle {CONFIG['usb_dongle']}")
-    try:
-        WYZESENSE_DONGLE = wyzesense.Open(CONFIG['usb_dongle'], on_event)
-        LOGGER.debug(f"Dongle {CONFIG['usb_dongle']}: ["
-                     f" MAC: {WYZESENSE_DONGLE.MAC},"
-                     f" VER: {WYZESENSE_DONGLE.Version},"
-                     f" ENR: {WYZESENSE_DONGLE.ENR}]")
-    except IOError as error:
-        LOGGER.warning(f"No device found on path {CONFIG['usb_dongle']}: {str(error)}")
+    retry_delay = 1
+    while True:
+        device_path = CONFIG['usb_dongle']
+        if (device_path.lower() == "auto"):
+            device_path = find_dongle() or device_path
+
+        LOGGER.info(f"Connecting to dongle {device_path}")
+        try:
+            WYZESENSE_DONGLE = wyzesense.Open(device_path, on_event)
+            LOGGER.debug("Dongle %s: [ MAC: %s, VER: %s, ENR: %s]",
+                         device_path,
+                         WYZESENSE_DONGLE.MAC,
+                         WYZESENSE_DONGLE.Version,
+                         WYZESENSE_DONGLE.ENR)
+            return
+        except IOError as error:
+            LOGGER.warning(f"No device found on path {device_path}: {str(error)}, retrying in {retry_delay}s")
+        time.sleep(retry_delay)
+        retry_delay = min(retry_delay * 2, 30)
 
 
 # Initialize sensor configuration
 def init_sensors():
-    # Initialize sensor dictionary
-    global SENSORS
-    SENSORS = {}
-
-    # Load config file
-    LOGGER.debug("Reading sensors configuration...")
-    if (os.path.isfile(os.path.join(CONFIG_PATH, SENSORS_CONFIG_FILE))):
-        SENSORS = read_yaml_file(os.path.join(CONFIG_PATH, SENSORS_CONFIG_FILE))
-        sensors_config_file_found = True
-    else:
-        LOGGER.info("No sensors config file found.")
-        sensors_config_file_found = False
-
-    # Add invert_state value if missing
-    for sensor_mac in SENSORS:
-        if (SENSORS[sensor_mac].get('invert_state') is None):
-            SENSORS[sensor_mac]['invert_state'] = False
+    global SENSORS, DISCOVERY_TOPICS
 
-    # Check config against linked sensors
+    # Get linked sensors before taking SENSORS_LOCK, the dongle thread delivers the reply
+    linked_sensors = []
     try:
         result = WYZESENSE_DONGLE.List()
-        LOGGER.debug(f"Linked sensors: {result}")
+        LOGGER.debug("Linked sensors: %s", result)
         if (result):
-            for sensor_mac in result:
-                if (valid_sensor_mac(sensor_mac)):
-                    if (SENSORS.get(sensor_mac) is None):
-                        add_sensor_to_config(sensor_mac, None, None)
+            linked_sensors = [sensor_mac for sensor_mac in result if valid_sensor_mac(sensor_mac)]
         else:
             LOGGER.warning(f"Sensor list failed with result: {result}")
     except TimeoutError:
         pass
 
-    # Save sensors file if didn't exist
-    if (not sensors_config_file_found):
-        LOGGER.info("Writing Sensors Config File")
-        write_yaml_file(os.path.join(CONFIG_PATH, SENSORS_CONFIG_FILE), SENSORS)
+    with SENSORS_LOCK:
+        # Initialize sensor dictionary and discovery cache
+        SENSORS = {}
+        DISCOVERY_TOPICS = {}
 
-    # Send discovery topics
-    if(CONFIG['hass_discovery']):
+        # Load config file
+        LOGGER.debug("Reading sensors configuration...")
+        if (os.path.isfile(os.path.join(CONFIG_PATH, SENSORS_CONFIG_FILE))):
+            SENSORS = read_yaml_file(os.path.join(CONFIG_PATH, SENSORS_CONFIG_FILE))
+            sensors_config_file_found = True
+        else:
+            LOGGER.info("No sensors config file found.")
+            sensors_config_file_found = False
+        sensors_config_changed = False
+
+        # Add invert_state value if missing
+        for sensor_mac in SENSORS:
+            if (SENSORS[sensor_mac].get('invert_state') is None):
+                SENSORS[sensor_mac]['invert_state'] = False
+
+        # Linked sensors missing from config, SENSORS is a dict so membership is O(1)
+        for sensor_mac in linked_sensors:
+            if (sensor_mac not in SENSORS):
+                add_sensor_to_config(sensor_mac, None, None, write_config=False)
+                sensors_config_changed = True
+
+        # Save sensors file once if it didn't exist or sensors were added
+        if ((not sensors_config_file_found) or sensors_config_changed):
+            LOGGER.info("Writing Sensors Config File")
+            write_yaml_file(os.path.join(CONFIG_PATH, SENSORS_CONFIG_FILE), SENSORS)
+
+        # Precompute state topics and discovery payloads so events are pure lookups
         for sensor_mac in SENSORS:
-            if (valid_sensor_mac(sensor_mac)):
-                send_discovery_topics(sensor_mac)
+            get_state_topic(sensor_mac)
+            if (HASS_DISCOVERY):
+                DISCOVERY_TOPICS[sensor_mac] = build_discovery_topics(sensor_mac)
+
+    # Send discovery topics, on_connect sends them if not connected yet
+    if (HASS_DISCOVERY and MQTT_CLIENT.is_connected()):
+        send_all_discovery_topics()
 
 
 # Validate sensor MAC
 def valid_sensor_mac(sensor_mac):
     #LOGGER.debug(f"Validating MAC: {sensor_mac}")
-    invalid_mac_list = [
-        "00000000",
-        "\0\0\0\0\0\0\0\0",
-        "\x00\x00\x00\x00\x00\x00\x00\x00"
-    ]
-    if ((len(str(sensor_mac)) == 8) and (sensor_mac not in invalid_mac_list)):
+    sensor_mac_str = str(sensor_mac)
+    if ((len(sensor_mac_str) == 8) and ("\0" not in sensor_mac_str) and (sensor_mac not in INVALID_MACS)):
         return True
     else:
         LOGGER.warning(f"Unpairing bad MAC: {sensor_mac}")
@@ -229,56 +376,117 @@ def valid_sensor_mac(sensor_mac):
 
 
 # Add sensor to config
-def add_sensor_to_config(sensor_mac, sensor_type, sensor_version):
+def add_sensor_to_config(sensor_mac, sensor_type, sensor_version, write_config=True):
     global SENSORS
-    LOGGER.info(f"Adding sensor to config: {sensor_mac}")
-    SENSORS[sensor_mac] = {
-        'name': f"Wyze Sense {sensor_mac}",
-        'class': DEVICE_CLASSES.get(sensor_type),
-        'invert_state': False
-    }
-    if (sensor_version is not None):
-        SENSORS[sensor_mac]['sw_version'] = sensor_version
+    LOGGER.info("Adding sensor to config: %s", sensor_mac)
+    with SENSORS_LOCK:
+        DISCOVERY_TOPICS.pop(sensor_mac, None)
+        SENSORS[sensor_mac] = {
+            'name': f"Wyze Sense {sensor_mac}",
+            'class': DEVICE_CLASSES.get(sensor_type),
+            'invert_state': False
+        }
+        if (sensor_version is not None):
+            SENSORS[sensor_mac]['sw_version'] = sensor_version
 
-    write_yaml_file(os.path.join(CONFIG_PATH, SENSORS_CONFIG_FILE), SENSORS)
+        if (write_config):
+            write_yaml_file(os.path.join(CONFIG_PATH, SENSORS_CONFIG_FILE), SENSORS)
 
 
 # Delete sensor from config
 def delete_sensor_from_config(sensor_mac):
     global SENSORS
     LOGGER.info(f"Deleting sensor from config: {sensor_mac}")
-    try:
-        del SENSORS[sensor_mac]
-        write_yaml_file(os.path.join(CONFIG_PATH, SENSORS_CONFIG_FILE), SENSORS)
-    except KeyError:
-        LOGGER.debug(f"{sensor_mac} not found in SENSORS")
+    with SENSORS_LOCK:
+        DISCOVERY_TOPICS.pop(sensor_mac, None)
+        try:
+            del SENSORS[sensor_mac]
+            write_yaml_file(os.path.join(CONFIG_PATH, SENSORS_CONFIG_FILE), SENSORS)
+        except KeyError:
+            LOGGER.debug("%s not found in SENSORS", sensor_mac)
+
+
+# Get sensor state topic, cached per MAC since it is used for every event
+def get_state_topic(sensor_mac):
+    state_topic = STATE_TOPICS.get(sensor_mac)
+    if (state_topic is None):
+        state_topic = f"{SELF_TOPIC_ROOT}/{sensor_mac}"
+        STATE_TOPICS[sensor_mac] = state_topic
+    return state_topic
 
 
 # Publish MQTT topic
 def mqtt_publish(mqtt_topic, mqtt_payload):
-    global MQTT_CLIENT, CONFIG
+    mqtt_publish_raw(mqtt_topic, json_dumps(mqtt_payload))
+
+
+# Publish already serialized payload to MQTT topic
+def mqtt_publish_raw(mqtt_topic, mqtt_payload):
+    global MQTT_CLIENT
     mqtt_message_info = MQTT_CLIENT.publish(
         mqtt_topic,
-        payload=json.dumps(mqtt_payload),
-        qos=CONFIG['mqtt_qos'],
-        retain=CONFIG['mqtt_retain']
+        payload=mqtt_payload,
+        qos=MQTT_QOS,
+        retain=MQTT_RETAIN
     )
     if (mqtt_message_info.rc != mqtt.MQTT_ERR_SUCCESS):
         LOGGER.warning(f"MQTT publish error: {mqtt.error_string(mqtt_message_info.rc)}")
 
 
+# Send discovery topics for all configured sensors
+def send_all_discovery_topics():
+    global SENSORS
+    with SENSORS_LOCK:
+        sensor_macs = list(SENSORS)
+    for sensor_mac in sensor_macs:
+        if (valid_sensor_mac(sensor_mac)):
+            send_discovery_topics(sensor_mac)
+
+
 # Send discovery topics
 def send_discovery_topics(sensor_mac):
-    global SENSORS, CONFIG
-
-    LOGGER.info(f"Publishing discovery topics for {sensor_mac}")
+    LOGGER.info("Publishing discovery topics for %s", sensor_mac)
+
+    # Discovery payloads only change with the sensor config, build them once
+    with SENSORS_LOCK:
+        discovery_topics = DISCOVERY_TOPICS.get(sensor_mac)
+        if (discovery_topics is None):
+            if (sensor_mac not in SENSORS):
+                LOGGER.debug("%s not found in SENSORS", sensor_mac)
+                return
+            discovery_topics = build_discovery_topics(sensor_mac)
+            DISCOVERY_TOPICS[sensor_mac] = discovery_topics
+
+    # Skip if this connection already carried identical discovery payloads
+    if (PUBLISHED_DISCOVERY_TOPICS.get(sensor_mac) == discovery_topics):
+        LOGGER.debug("Discovery topics for %s unchanged, skipping", sensor_mac)
+        return
+    PUBLISHED_DISCOVERY_TOPICS[sensor_mac] = discovery_topics
+
+    for entity_topic, entity_payload in discovery_topics:
+        # The broker may already retain this exact payload from a previous run
+        retained_payload = RETAINED_DISCOVERY_PAYLOADS.get(entity_topic)
+        if ((retained_payload is not None) and (retained_payload == to_bytes(entity_payload))):
+            LOGGER.debug("  %s already retained, skipping", entity_topic)
+            continue
+        mqtt_publish_raw(entity_topic, entity_payload)
+        LOGGER.debug("  %s", entity_topic)
+
+
+# Encode payload for comparison with received MQTT payloads
+def to_bytes(payload):
+    if (isinstance(payload, str)):
+        return payload.encode()
+    return payload
+
+
+# Build serialized discovery topics and payloads for a sensor
+def build_discovery_topics(sensor_mac):
+    global SENSORS
 
     sensor_name = SENSORS[sensor_mac]['name']
     sensor_class = SENSORS[sensor_mac]['class']
-    if (SENSORS[sensor_mac].get('sw_version') is not None):
-        sensor_version = SENSORS[sensor_mac]['sw_version']
-    else:
-        sensor_version = ""
+    sensor_version = SENSORS[sensor_mac].get('sw_version')
 
     device_payload = {
         'identifiers': [f"wyzesense_{sensor_mac}", sensor_mac],
@@ -287,9 +495,11 @@ def send_discovery_topics(sensor_mac):
             "Sense Motion Sensor" if (sensor_class == "motion")
             else "Sense Contact Sensor"
         ),
-        'name': sensor_name,
-        'sw_version': sensor_version
+        'name': sensor_name
     }
+    # Omit unknown versions rather than publishing an empty string
+    if (sensor_version is not None):
+        device_payload['sw_version'] = sensor_version
 
     entity_payloads = {
         'state': {
@@ -297,7 +507,7 @@ def send_discovery_topics(sensor_mac):
             'dev_cla': sensor_class,
             'pl_on': "1",
             'pl_off': "0",
-            'json_attr_t': f"{CONFIG['self_topic_root']}/{sensor_mac}"
+            'json_attr_t': get_state_topic(sensor_mac)
         },
         'signal_strength': {
             'name': f"{sensor_name} Signal Strength",
@@ -311,45 +521,46 @@ def send_discovery_topics(sensor_mac):
         }
     }
 
-    for entity, entity_payload in entity_payloads.items():
+    discovery_topics = []
+    for entity, topic_template in DISCOVERY_TOPIC_TEMPLATES:
+        entity_payload = entity_payloads[entity]
         entity_payload['val_tpl'] = f"{{{{ value_json.{entity} }}}}"
         entity_payload['uniq_id'] = f"wyzesense_{sensor_mac}_{entity}"
-        entity_payload['stat_t'] = f"{CONFIG['self_topic_root']}/{sensor_mac}"
+        entity_payload['stat_t'] = get_state_topic(sensor_mac)
         entity_payload['dev'] = device_payload
-        sensor_type = ("binary_sensor" if (entity == "state") else "sensor")
 
-        entity_topic = f"{CONFIG['hass_topic_root']}/{sensor_type}/wyzesense_{sensor_mac}/{entity}/config"
-        mqtt_publish(entity_topic, entity_payload)
-        LOGGER.debug(f"  {entity_topic}")
-        LOGGER.debug(f"  {json.dumps(entity_payload)}")
+        entity_topic = topic_template % sensor_mac
+        discovery_topics.append((entity_topic, json_dumps(entity_payload)))
+        if (LOGGER.isEnabledFor(logging.DEBUG)):
+            LOGGER.debug("  %s", json.dumps(entity_payload))
+
+    return discovery_topics
 
 
 # Clear any retained topics in MQTT
 def clear_topics(sensor_mac):
-    global CONFIG
     LOGGER.info("Clearing sensor topics")
-    state_topic = f"{CONFIG['self_topic_root']}/{sensor_mac}"
-    mqtt_publish(state_topic, None)
+    LAST_EVENT_KEYS.pop(sensor_mac, None)
+    PUBLISHED_DISCOVERY_TOPICS.pop(sensor_mac, None)
+
+    # An empty payload deletes a retained message, a JSON "null" would be retained instead
+    mqtt_publish_raw(get_state_topic(sensor_mac), None)
 
     # clear discovery topics if configured
-    if(CONFIG['hass_discovery']):
-        entity_types = ['state', 'signal_strength', 'battery']
-        for entity_type in entity_types:
-            sensor_type = (
-                "binary_sensor" if (entity_type == "state")
-                else "sensor"
-            )
-            entity_topic = f"{CONFIG['hass_topic_root']}/{sensor_type}/wyzesense_{sensor_mac}/{entity_type}/config"
-            mqtt_publish(entity_topic, None)
+    if (HASS_DISCOVERY):
+        for entity, topic_template in DISCOVERY_TOPIC_TEMPLATES:
+            entity_topic = topic_template % sensor_mac
+            with RETAINED_DISCOVERY_LOCK:
+                RETAINED_DISCOVERY_PAYLOADS.pop(entity_topic, None)
+            mqtt_publish_raw(entity_topic, None)
 
 
 def on_connect(MQTT_CLIENT, userdata, flags, rc):
-    global CONFIG
     if rc == mqtt.MQTT_ERR_SUCCESS:
         MQTT_CLIENT.subscribe(
-            [(SCAN_TOPIC, CONFIG['mqtt_qos']),
-             (REMOVE_TOPIC, CONFIG['mqtt_qos']),
-             (RELOAD_TOPIC, CONFIG['mqtt_qos'])]
+            [(SCAN_TOPIC, MQTT_QOS),
+             (REMOVE_TOPIC, MQTT_QOS),
+             (RELOAD_TOPIC, MQTT_QOS)]
         )
         MQTT_CLIENT.message_callback_add(SCAN_TOPIC, on_message_scan)
         MQTT_CLIENT.message_callback_add(REMOVE_TOPIC, on_message_remove)
@@ -357,14 +568,92 @@ def on_connect(MQTT_CLIENT, userdata, flags, rc):
         # Used for alternate MQTT connection method
         # MQTT_CLIENT.connected_flag = True
         LOGGER.info(f"Connected to MQTT: {mqtt.error_string(rc)}")
+
+        # A new connection may follow a broker restart, so publish them all again,
+        # except payloads the broker still retains. Collect those briefly first.
+        if (HASS_DISCOVERY):
+            PUBLISHED_DISCOVERY_TOPICS.clear()
+            collect_retained_discovery()
     else:
         LOGGER.warning(f"Connection to MQTT failed: {mqtt.error_string(rc)}")
 
 
+# Subscribe to the retained discovery topics of known sensors, then send discovery topics after a short delay
+def collect_retained_discovery():
+    global RETAINED_DISCOVERY_TOPICS, RETAINED_DISCOVERY_TIMER, RETAINED_DISCOVERY_GENERATION
+
+    # Exact topics only, a wildcard would also pull in every other retained discovery config
+    with SENSORS_LOCK:
+        sensor_macs = [sensor_mac for sensor_mac in SENSORS if valid_sensor_mac(sensor_mac)]
+    retained_topics = [
+        topic_template % sensor_mac
+        for sensor_mac in sensor_macs
+        for entity, topic_template in DISCOVERY_TOPIC_TEMPLATES
+    ]
+    if (not retained_topics):
+        return
+
+    with RETAINED_DISCOVERY_LOCK:
+        if (RETAINED_DISCOVERY_TIMER is not None):
+            RETAINED_DISCOVERY_TIMER.cancel()
+        RETAINED_DISCOVERY_GENERATION += 1
+        RETAINED_DISCOVERY_PAYLOADS.clear()
+        RETAINED_DISCOVERY_TOPICS = retained_topics
+        RETAINED_DISCOVERY_TIMER = threading.Timer(1.0, send_discovery_after_retained, args=(RETAINED_DISCOVERY_GENERATION,))
+        RETAINED_DISCOVERY_TIMER.daemon = True
+        retained_timer = RETAINED_DISCOVERY_TIMER
+
+    for retained_topic in retained_topics:
+        MQTT_CLIENT.message_callback_add(retained_topic, on_message_retained_discovery)
+    MQTT_CLIENT.subscribe([(retained_topic, 0) for retained_topic in retained_topics])
+    retained_timer.start()
+
+
+# Stop collecting retained discovery topics and send any that differ
+def send_discovery_after_retained(generation):
+    global RETAINED_DISCOVERY_TIMER
+
+    # A disconnect or newer connection since the timer started owns the collection now
+    with RETAINED_DISCOVERY_LOCK:
+        if (generation != RETAINED_DISCOVERY_GENERATION):
+            return
+        RETAINED_DISCOVERY_TIMER = None
+        retained_topics = RETAINED_DISCOVERY_TOPICS
+
+    MQTT_CLIENT.unsubscribe(retained_topics)
+    for retained_topic in retained_topics:
+        MQTT_CLIENT.message_callback_remove(retained_topic)
+    LOGGER.debug("Collected %d retained discovery topics", len(RETAINED_DISCOVERY_PAYLOADS))
+    send_all_discovery_topics()
+
+    # Later changes are tracked by PUBLISHED_DISCOVERY_TOPICS
+    with RETAINED_DISCOVERY_LOCK:
+        if (generation == RETAINED_DISCOVERY_GENERATION):
+            RETAINED_DISCOVERY_PAYLOADS.clear()
+
+
+# Record retained discovery payloads for our sensors
+def on_message_retained_discovery(MQTT_CLIENT, userdata, msg):
+    if (msg.retain):
+        with RETAINED_DISCOVERY_LOCK:
+            RETAINED_DISCOVERY_PAYLOADS[msg.topic] = msg.payload
+
+
 def on_disconnect(MQTT_CLIENT, userdata, rc):
+    global RETAINED_DISCOVERY_TIMER, RETAINED_DISCOVERY_GENERATION
     MQTT_CLIENT.message_callback_remove(SCAN_TOPIC)
     MQTT_CLIENT.message_callback_remove(REMOVE_TOPIC)
     MQTT_CLIENT.message_callback_remove(RELOAD_TOPIC)
+
+    # Abandon a retained discovery collection in progress, the next connection starts over
+    with RETAINED_DISCOVERY_LOCK:
+        if (RETAINED_DISCOVERY_TIMER is not None):
+            RETAINED_DISCOVERY_TIMER.cancel()
+            RETAINED_DISCOVERY_TIMER = None
+        RETAINED_DISCOVERY_GENERATION += 1
+        retained_topics = RETAINED_DISCOVERY_TOPICS
+    for retained_topic in retained_topics:
+        MQTT_CLIENT.message_callback_remove(retained_topic)
     # Used for alternate MQTT connection method
     # MQTT_CLIENT.connected_flag = False
     LOGGER.info(f"Disconnected from MQTT: {mqtt.error_string(rc)}")
@@ -372,39 +661,39 @@ def on_disconnect(MQTT_CLIENT, userdata, rc):
 
 # Process messages
 def on_message(MQTT_CLIENT, userdata, msg):
-    LOGGER.info(f"{msg.topic}: {str(msg.payload)}")
+    LOGGER.info("%s: %s", msg.topic, msg.payload)
 
 
 # Process message to scan for new sensors
 def on_message_scan(MQTT_CLIENT, userdata, msg):
     global SENSORS
-    LOGGER.info(f"In on_message_scan: {msg.payload.decode()}")
+    LOGGER.info("In on_message_scan: %s", msg.payload.decode())
 
     try:
         result = WYZESENSE_DONGLE.Scan()
-        LOGGER.debug(f"Scan result: {result}")
-        if (result):
-            sensor_mac, sensor_type, sensor_version = result
-            if (valid_sensor_mac(sensor_mac)):
-                if (SENSORS.get(sensor_mac)) is None:
-                    add_sensor_to_config(
-                        sensor_mac,
-                        sensor_type,
-                        sensor_version
-                    )
-                    if(CONFIG['hass_discovery']):
-                        send_discovery_topics(sensor_mac)
-            else:
-                LOGGER.debug(f"Invalid sensor found: {sensor_mac}")
-        else:
-            LOGGER.debug("No new sensor found")
     except TimeoutError:
-        pass
+        return
+
+    LOGGER.debug("Scan result: %s", result)
+    if (not result):
+        LOGGER.debug("No new sensor found")
+        return
+
+    sensor_mac, sensor_type, sensor_version = result
+    if (not valid_sensor_mac(sensor_mac)):
+        LOGGER.debug("Invalid sensor found: %s", sensor_mac)
+    else:
+        with SENSORS_LOCK:
+            sensor_added = (sensor_mac not in SENSORS)
+            if (sensor_added):
+                add_sensor_to_config(sensor_mac, sensor_type, sensor_version)
+        if (sensor_added and HASS_DISCOVERY):
+            send_discovery_topics(sensor_mac)
 
 
 # Process message to remove sensor
 def on_message_remove(MQTT_CLIENT, userdata, msg):
-    LOGGER.info(f"In on_message_remove: {msg.payload.decode()}")
+    LOGGER.info("In on_message_remove: %s", msg.payload.decode())
     sensor_mac = msg.payload.decode()
 
     if (valid_sensor_mac(sensor_mac)):
@@ -415,12 +704,12 @@ def on_message_remove(MQTT_CLIENT, userdata, msg):
         except TimeoutError:
             pass
     else:
-        LOGGER.debug(f"Invalid mac address: {sensor_mac}")
+        LOGGER.debug("Invalid mac address: %s", sensor_mac)
 
 
 # Process message to reload sensors
 def on_message_reload(MQTT_CLIENT, userdata, msg):
-    LOGGER.info(f"In on_message_reload: {msg.payload.decode()}")
+    LOGGER.info("In on_message_reload: %s", msg.payload.decode())
     init_sensors()
 
 
@@ -428,65 +717,81 @@ def on_message_reload(MQTT_CLIENT, userdata, msg):
 def on_event(WYZESENSE_DONGLE, event):
     global SENSORS
 
-    # List of states that correlate to ON.
-    STATES_ON = ['active', 'open', 'wet']
-
     if (valid_sensor_mac(event.MAC)):
         if (event.Type == "alarm") or (event.Type == "status"):
-            LOGGER.info(f"State event data: {event}")
+            LOGGER.info("State event data: %s", event)
             (sensor_type, sensor_state, sensor_battery, sensor_signal) = event.Data
 
             # Add sensor if it doesn't already exist
-            if (event.MAC not in SENSORS):
-                add_sensor_to_config(event.MAC, sensor_type, None)
-                if(CONFIG['hass_discovery']):
-                    send_discovery_topics(event.MAC)
+            with SENSORS_LOCK:
+                sensor_added = (event.MAC not in SENSORS)
+                if (sensor_added):
+                    add_sensor_to_config(event.MAC, sensor_type, None)
+                sensor = SENSORS[event.MAC]
+            if (sensor_added and HASS_DISCOVERY):
+                send_discovery_topics(event.MAC)
 
-            # Build event payload
+            # Set state depending on state string and `invert_state` setting.
+            #     State ON ^ NOT Inverted = True
+            #     State OFF ^ NOT Inverted = False
+            #     State ON ^ Inverted = False
+            #     State OFF ^ Inverted = True
+            sensor_state = int((sensor_state in STATES_ON) ^ (sensor.get('invert_state')))
+
+            # Skip events the dongle repeats, the key leaves out the timestamps
+            # so only a change in state, battery, signal or name is published
+            sensor_name = sensor['name'] if (PUBLISH_SENSOR_NAME) else None
+            event_key = (sensor_state, sensor_battery, sensor_signal, sensor_name)
+            if (LAST_EVENT_KEYS.get(event.MAC) == event_key):
+                LOGGER.debug("Skipping duplicate event for %s", event.MAC)
+                return
+            LAST_EVENT_KEYS[event.MAC] = event_key
+
+            # Build event payload in a single dict literal
             event_payload = {
                 'event': event.Type,
                 'available': True,
                 'mac': event.MAC,
                 'device_class': DEVICE_CLASSES.get(sensor_type),
                 'last_seen': event.Timestamp.timestamp(),
-                'last_seen_iso': event.Timestamp.isoformat(),
-                'signal_strength': sensor_signal * -1,
-                'battery': sensor_battery
+                'last_seen_iso': event.Timestamp,
+                'signal_strength': -sensor_signal,
+                'battery': sensor_battery,
+                'state': sensor_state
             }
 
-            if (CONFIG['publish_sensor_name']):
-                event_payload['name'] = SENSORS[event.MAC]['name']
-
-            # Set state depending on state string and `invert_state` setting.
-            #     State ON ^ NOT Inverted = True
-            #     State OFF ^ NOT Inverted = False
-            #     State ON ^ Inverted = False
-            #     State OFF ^ Inverted = True
-            event_payload['state'] = int((sensor_state in STATES_ON) ^ (SENSORS[event.MAC].get('invert_state')))
-
-            LOGGER.debug(event_payload)
+            if (PUBLISH_SENSOR_NAME):
+                event_payload['name'] = sensor_name
 
-            state_topic = f"{CONFIG['self_topic_root']}/{event.MAC}"
-            mqtt_publish(state_topic, event_payload)
+            event_json = json_dumps(event_payload)
+            LOGGER.debug("Event payload: %s", event_json)
+            mqtt_publish_raw(get_state_topic(event.MAC), event_json)
         else:
-            LOGGER.debug(f"Non-state event data: {event}")
+            LOGGER.debug("Non-state event data: %s", event)
 
     else:
         LOGGER.warning("!Invalid MAC detected!")
-        LOGGER.warning(f"Event data: {event}")
+        LOGGER.warning("Event data: %s", event)
+
+
+# Exit on SIGTERM (docker stop, systemd) so cleanup and atexit handlers run,
+# the default action kills the process before queued log records are written
+def on_sigterm(signum, frame):
+    raise SystemExit(0)
 
 
 if __name__ == "__main__":
     # Initialize logging
     init_logging()
+    signal.signal(signal.SIGTERM, on_sigterm)
 
     # Initialize configuration
     init_config()
 
     # Set MQTT Topics
-    SCAN_TOPIC = f"{CONFIG['self_topic_root']}/scan"
-    REMOVE_TOPIC = f"{CONFIG['self_topic_root']}/remove"
-    RELOAD_TOPIC = f"{CONFIG['self_topic_root']}/reload"
+    SCAN_TOPIC = f"{SELF_TOPIC_ROOT}/scan"
+    REMOVE_TOPIC = f"{SELF_TOPIC_ROOT}/remove"
+    RELOAD_TOPIC = f"{SELF_TOPIC_ROOT}/reload"
 
     # Initialize MQTT client connection
     init_mqtt_client()
@@ -497,18 +802,17 @@ if __name__ == "__main__":
     # Initialize sensor configuration
     init_sensors()
 
-    # Loop forever until keyboard interrupt or SIGINT
+    # Run the MQTT network loop in its own thread so publishes from the
+    # dongle thread are queued rather than written inline
+    MQTT_CLIENT.loop_start()
+
+    # Wait forever until keyboard interrupt, SIGINT or SIGTERM
     try:
         while True:
-            MQTT_CLIENT.loop_forever(retry_first_connection=False)
-
-            # Used for alternate MQTT connection method
-            # signal.pause()
+            signal.pause()
     except KeyboardInterrupt:
         pass
     finally:
-        # Used with alternate MQTT connection method
-        # MQTT_CLIENT.loop_stop()
-
         MQTT_CLIENT.disconnect()
+        MQTT_CLIENT.loop_stop()
         WYZESENSE_DONGLE.Stop()